@@ -1,18 +1,28 @@
 # backend/main.py
+import hashlib
 import os
+import re
 import shutil
 import sqlite3
+import threading
+import time
 from datetime import datetime, timezone, timedelta
 from typing import List, Optional
 
+import bcrypt
+from cachetools import TTLCache
 from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String, create_engine
+from pydantic import BaseModel, ConfigDict
+from pydantic_core import to_json
+from sqlalchemy import (
+    Column, DateTime, Float, ForeignKey, Index, Integer, String,
+    and_, bindparam, case, create_engine, delete, event, func, insert, or_, select,
+)
 from sqlalchemy.orm import Session, declarative_base, relationship, sessionmaker
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from sqlalchemy.pool import QueuePool
+import jwt
 from starlette.responses import Response
 from starlette.status import HTTP_401_UNAUTHORIZED
 
@@ -42,6 +52,29 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "change_this_secret_for_prod")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# bcrypt cost factor: each +1 doubles hash time (~55 ms at 10, ~105 ms at 11, ~210 ms at 12).
+# 11 keeps /login and /register responsive; raise it via env on faster hardware.
+# Existing hashes carry their own cost, so changing this never breaks logins.
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "11"))
+
+# Verified tokens are cached briefly so hot endpoints skip jwt.decode + the user SELECT
+TOKEN_CACHE_TTL_SECONDS = 60
+_tok_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL_SECONDS)
+_tok_lock = threading.Lock()  # cachetools caches are not thread-safe
+
+# /summary results per user; dashboards poll it repeatedly. Writes evict the entry,
+# the TTL bounds staleness when several workers each hold their own cache.
+SUMMARY_CACHE_TTL_SECONDS = 10
+_summary_cache = TTLCache(maxsize=10000, ttl=SUMMARY_CACHE_TTL_SECONDS)
+_summary_lock = threading.Lock()  # cachetools caches are not thread-safe
+# per-user write counter: a summary computed across a write must not be stored
+_summary_gen = {}
+
+def invalidate_summary(uid: int):
+    with _summary_lock:
+        _summary_gen[uid] = _summary_gen.get(uid, 0) + 1
+        _summary_cache.pop(uid, None)
+
 # ---------- DB integrity check (if corrupted, rename and start fresh) ----------
 def check_and_rename_corrupt(db_path: str):
     if not os.path.exists(db_path):
@@ -59,12 +92,33 @@ def check_and_rename_corrupt(db_path: str):
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
     corrupt = os.path.join(BASE_DIR, f"database_corrupt_{ts}.db")
     shutil.move(db_path, corrupt)
+    for suffix in ("-wal", "-shm"):  # WAL sidecar files belong to the old DB
+        if os.path.exists(db_path + suffix):
+            shutil.move(db_path + suffix, corrupt + suffix)
     print(f"[DB] Renamed corrupted DB -> {corrupt}")
 
 check_and_rename_corrupt(DB_PATH)
 
 # ---------- SQLAlchemy setup ----------
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# SQLAlchemy's default pool for file-based SQLite, spelled out so the connection budget
+# (5 + 10 overflow) is visible; no pre-ping, which would add a SELECT 1 per checkout
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=5,
+    max_overflow=10,
+)
+
+# WAL lets readers run alongside a writer; NORMAL skips the fsync on every commit
+@event.listens_for(engine, "connect")
+def _set_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    for p in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+              "cache_size=-64000", "mmap_size=268435456", "foreign_keys=ON"):
+        cur.execute(f"PRAGMA {p}")
+    cur.close()
+
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 Base = declarative_base()
 
@@ -74,42 +128,70 @@ class UserDB(Base):
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
-    transactions = relationship("TransactionDB", back_populates="owner", cascade="all, delete-orphan")
+    # lazy="raise": endpoints query columns explicitly, so any implicit load is an N+1 bug
+    transactions = relationship("TransactionDB", back_populates="owner", cascade="all, delete-orphan", lazy="raise")
 
 # Define IST timezone (UTC+5:30)
 IST = timezone(timedelta(hours=5, minutes=30))
 
+def now_ist():
+    return datetime.now(IST)
+
 
 class TransactionDB(Base):
     __tablename__ = "transactions"
+    # serves "WHERE owner_id=? ORDER BY date DESC" without a sort step
+    __table_args__ = (Index("ix_tx_owner_date", "owner_id", "date"),)
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, nullable=False)
     amount = Column(Float, nullable=False)
     type = Column(String, nullable=False)  # "income" or "expense"
     category = Column(String, nullable=True)
-    IST = timezone(timedelta(hours=5, minutes=30))  # UTC+5:30
-    date = Column(DateTime(timezone=True), default=lambda: datetime.now(IST))
+    date = Column(DateTime(timezone=True), default=now_ist)
 
     owner_id = Column(Integer, ForeignKey("users.id"))
-    owner = relationship("UserDB", back_populates="transactions")
-
-    # ensure tables exist (create them if missing)
-    Base.metadata.create_all(bind=engine)
+    owner = relationship("UserDB", back_populates="transactions", lazy="raise")
+
+
+# ensure tables exist (create them if missing)
+Base.metadata.create_all(bind=engine)
+# create_all only adds indexes alongside new tables, so backfill them on existing DBs
+for _idx in TransactionDB.__table__.indexes:
+    _idx.create(bind=engine, checkfirst=True)
+
+# ---------- Prebuilt statements ----------
+# Built once at import; endpoints only bind parameters per request
+_TX_BY_OWNER = (
+    select(TransactionDB.id, TransactionDB.title, TransactionDB.amount,
+           TransactionDB.type, TransactionDB.category, TransactionDB.date)
+    .where(TransactionDB.owner_id == bindparam("uid"))
+    .order_by(TransactionDB.date.desc())
+)
+# column names of _TX_BY_OWNER, in TransactionResponse field order
+_TX_FIELDS = tuple(_TX_BY_OWNER.selected_columns.keys())
+_DELETE_TX_BY_ID_AND_OWNER = delete(TransactionDB).where(
+    TransactionDB.id == bindparam("tx_id"), TransactionDB.owner_id == bindparam("uid")
+)
+_SUMMARY_BY_OWNER = select(
+    func.coalesce(func.sum(case((TransactionDB.type == "income", TransactionDB.amount), else_=0)), 0),
+    func.coalesce(func.sum(case((TransactionDB.type == "expense", TransactionDB.amount), else_=0)), 0),
+).where(TransactionDB.owner_id == bindparam("uid"))
 
 
 # ---------- Security utils ----------
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
+# bcrypt is called directly: passlib's CryptContext only adds scheme dispatch on top.
+# Inputs are cut to bcrypt's 72-byte limit, matching passlib's truncation of existing hashes.
 def verify_password(plain, hashed):
-    return pwd_context.verify(plain, hashed)
+    return bcrypt.checkpw(plain.encode()[:72], hashed.encode())
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode()[:72], bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
+    # integer epoch seconds, which is what the "exp" claim holds on the wire anyway
+    lifetime = expires_delta.total_seconds() if expires_delta else ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    to_encode.update({"exp": int(time.time() + lifetime)})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 # ---------- Pydantic schemas ----------
@@ -136,8 +218,7 @@ class TransactionResponse(BaseModel):
     category: Optional[str] = None
     date: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class SummaryResponse(BaseModel):
     total_income: float
@@ -145,6 +226,8 @@ class SummaryResponse(BaseModel):
     net_balance: float
 
 # ---------- DB dependency ----------
+# Sessions stay per-request (cheap); close() hands the connection back to the pool.
+# A thread-local scoped_session is avoided: FastAPI may run setup/teardown on different threads.
 def get_db():
     db = SessionLocal()
     try:
@@ -166,13 +249,41 @@ def get_current_user_from_token(token: str, db: Session):
         username: str = payload.get("sub")
         if not username:
             raise credentials_exception
-    except JWTError:
+    except jwt.InvalidTokenError:
         raise credentials_exception
     user = db.query(UserDB).filter(UserDB.username == username).first()
     if user is None:
         raise credentials_exception
     return user
 
+def get_current_uid_from_token(token: str, db: Session) -> int:
+    # Protected endpoints only need owner_id, which the token carries as "uid"
+    key = hashlib.sha256(token.encode()).digest()
+    with _tok_lock:
+        cached = _tok_cache.get(key)
+        if cached is not None and time.time() > cached["exp"]:
+            _tok_cache.pop(key, None)
+            cached = None
+    if cached is not None:
+        return cached["uid"]
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        raise credentials_exception
+    username = payload.get("sub")
+    if not username:
+        raise credentials_exception
+    uid = payload.get("uid")
+    if uid is None:
+        # tokens issued before "uid" was embedded still need the user lookup
+        uid = get_current_user_from_token(token, db).id
+    # only reached for valid tokens; invalid ones raise above and are never cached
+    if "exp" in payload:
+        with _tok_lock:
+            _tok_cache[key] = {"uid": uid, "exp": payload["exp"]}
+    return uid
+
 # ---------- Routes ----------
 @app.post("/register", status_code=201)
 def register(user: UserCreate, db: Session = Depends(get_db)):
@@ -196,20 +307,21 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
 def login(payload: UserCreate, db: Session = Depends(get_db)):
     # Accepts JSON {username, password}
     user = db.query(UserDB).filter(UserDB.username == payload.username).first()
-    if not user or not verify_password(payload.password, user.hashed_password):
+    ok = user and verify_password(payload.password, user.hashed_password)
+    if not ok:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_access_token({"sub": user.username})
+    token = create_access_token({"sub": user.username, "uid": user.id})
     return {"access_token": token, "token_type": "bearer"}
 
 # Protected helper used inside endpoints
-def require_user_from_header(authorization_header: Optional[str], db: Session):
+def require_uid_from_header(authorization_header: Optional[str], db: Session) -> int:
     if not authorization_header:
         raise HTTPException(status_code=401, detail="Authorization header missing")
     parts = authorization_header.split()
     if len(parts) != 2 or parts[0].lower() != "bearer":
         raise HTTPException(status_code=401, detail="Invalid auth header")
     token = parts[1]
-    return get_current_user_from_token(token, db)
+    return get_current_uid_from_token(token, db)
 
 @app.post("/add-transaction", response_model=TransactionResponse)
 def add_transaction(tx: TransactionCreate, authorization: Optional[str] = None, db: Session = Depends(get_db)):
@@ -227,77 +339,128 @@ from fastapi import Header, Request
 
 @app.post("/tx/add", response_model=TransactionResponse)
 def add_transaction_protected(tx: TransactionCreate, authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    user = require_user_from_header(authorization, db)
+    uid = require_uid_from_header(authorization, db)
 
     # Always use IST if no date is provided
-    tx_date = tx.date if tx.date else datetime.now(IST)
+    tx_date = tx.date if tx.date else now_ist()
 
     # If user gave date without tz, convert it to IST
     if tx.date and not tx.date.tzinfo:
         tx_date = tx.date.replace(tzinfo=IST)
 
-    db_tx = TransactionDB(
-        title=tx.title,
-        amount=tx.amount,
-        type=tx.type,
-        category=tx.category,
-        date=tx_date,
-        owner_id=user.id
-    )
-    db.add(db_tx)
+    # one round trip: RETURNING replaces the add/flush + refresh SELECT
+    row = db.execute(
+        insert(TransactionDB)
+        .values(
+            title=tx.title,
+            amount=tx.amount,
+            type=tx.type,
+            category=tx.category,
+            date=tx_date,
+            owner_id=uid
+        )
+        .returning(TransactionDB.id, TransactionDB.date)
+    ).one()
     db.commit()
-    db.refresh(db_tx)
-    return db_tx
+    invalidate_summary(uid)
+    return TransactionResponse(id=row.id, title=tx.title, amount=tx.amount, type=tx.type, category=tx.category, date=row.date)
 
 @app.get("/transactions", response_model=List[TransactionResponse])
 def get_transactions_protected(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    user = require_user_from_header(authorization, db)
-    rows = db.query(TransactionDB).filter(TransactionDB.owner_id == user.id).order_by(TransactionDB.date.desc()).all()
-    return rows
+    uid = require_uid_from_header(authorization, db)
+    rows = db.execute(_TX_BY_OWNER, {"uid": uid}).all()
+    # rows come straight from our own schema, so skip per-row model validation and
+    # serialize plain dicts; response_model stays for the OpenAPI docs
+    return Response(content=to_json([dict(zip(_TX_FIELDS, r)) for r in rows]), media_type="application/json")
 
 @app.delete("/delete-transaction/{tx_id}")
 def delete_transaction_protected(tx_id: int, authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    user = require_user_from_header(authorization, db)
-    tx = db.query(TransactionDB).filter(TransactionDB.id == tx_id, TransactionDB.owner_id == user.id).first()
-    if not tx:
+    uid = require_uid_from_header(authorization, db)
+    # one DELETE scoped to the owner; rowcount tells us whether it existed
+    res = db.execute(_DELETE_TX_BY_ID_AND_OWNER, {"tx_id": tx_id, "uid": uid})
+    if res.rowcount == 0:
         raise HTTPException(status_code=404, detail="Transaction not found")
-    db.delete(tx)
     db.commit()
+    invalidate_summary(uid)
     return {"status": "success", "message": f"Transaction {tx_id} deleted"}
 
 @app.get("/summary", response_model=SummaryResponse)
 def summary_protected(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    user = require_user_from_header(authorization, db)
-    transactions = db.query(TransactionDB).filter(TransactionDB.owner_id == user.id).all()
-    total_income = round(sum(t.amount for t in transactions if t.type == "income"), 2)
-    total_expense = round(sum(t.amount for t in transactions if t.type == "expense"), 2)
-    return SummaryResponse(total_income=total_income, total_expense=total_expense, net_balance=round(total_income - total_expense, 2))
+    uid = require_uid_from_header(authorization, db)
+    with _summary_lock:
+        cached = _summary_cache.get(uid)
+        gen = _summary_gen.get(uid, 0)
+    if cached is not None:
+        return cached
+    # single SQL aggregate; rows are never loaded into Python
+    row = db.execute(_SUMMARY_BY_OWNER, {"uid": uid}).one()
+    total_income = round(row[0], 2)
+    total_expense = round(row[1], 2)
+    result = SummaryResponse(total_income=total_income, total_expense=total_expense, net_balance=round(total_income - total_expense, 2))
+    with _summary_lock:
+        if _summary_gen.get(uid, 0) == gen:
+            _summary_cache[uid] = result
+    return result
 
 # Export CSV for current user
-def iter_csv(rows):
+CSV_CHUNK_ROWS = 1000
+
+# Keyset pages over (date, id) DESC; id breaks ties so no row is skipped or repeated
+_TX_EXPORT_FIRST_PAGE = (
+    _TX_BY_OWNER.order_by(None)
+    .order_by(TransactionDB.date.desc(), TransactionDB.id.desc())
+    .limit(CSV_CHUNK_ROWS)
+)
+_TX_EXPORT_NEXT_PAGE = _TX_EXPORT_FIRST_PAGE.where(or_(
+    TransactionDB.date < bindparam("last_date"),
+    and_(TransactionDB.date == bindparam("last_date"), TransactionDB.id < bindparam("last_id")),
+))
+
+def iter_csv(owner_id: int):
     import csv
     from io import StringIO
     buffer = StringIO()
     writer = csv.writer(buffer)
     writer.writerow(["id", "title", "amount", "type", "category", "date"])
-    yield buffer.getvalue()
-    buffer.seek(0); buffer.truncate(0)
-    for r in rows:
-        writer.writerow([r.id, r.title, r.amount, r.type, r.category or "", r.date.isoformat()])
+    stmt, params = _TX_EXPORT_FIRST_PAGE, {"uid": owner_id}
+    while True:
+        # short-lived connection per page: the request session may already be closed, and a
+        # slow client must not pin a pooled connection (and its WAL snapshot) for the whole download
+        with engine.connect() as conn:
+            rows = conn.execute(stmt, params).all()
+        for r in rows:
+            writer.writerow([r.id, r.title, r.amount, r.type, r.category or "", r.date.isoformat()])
         yield buffer.getvalue()
         buffer.seek(0); buffer.truncate(0)
+        if len(rows) < CSV_CHUNK_ROWS:
+            break
+        last = rows[-1]
+        stmt, params = _TX_EXPORT_NEXT_PAGE, {"uid": owner_id, "last_date": last.date, "last_id": last.id}
 
 @app.get("/export-csv")
 def export_csv_protected(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
-    user = require_user_from_header(authorization, db)
-    rows = db.query(TransactionDB).filter(TransactionDB.owner_id == user.id).order_by(TransactionDB.date.desc()).all()
-    return StreamingResponse(iter_csv(rows), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=transactions.csv"})
-
+    uid = require_uid_from_header(authorization, db)
+    return StreamingResponse(iter_csv(uid), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=transactions.csv"})
 
 from fastapi.staticfiles import StaticFiles
 import os
 
+# Fingerprinted assets (e.g. app.3f9c2a1b.js) never change under the same name
+HASHED_ASSET_RE = re.compile(r"\.[0-9a-f]{8,}\.[A-Za-z0-9]+$")
+
+class CachedStaticFiles(StaticFiles):
+    # Browsers keep hashed assets forever; everything else (HTML, plain-named JS)
+    # is revalidated via ETag/Last-Modified so unchanged files come back as 304s
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if HASHED_ASSET_RE.search(os.path.basename(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+# In production a reverse proxy (nginx/CDN) can serve this directory directly
 frontend_path = os.path.join(os.path.dirname(__file__), "../frontend")
-app.mount("/", StaticFiles(directory=frontend_path, html=True), name="frontend")
+app.mount("/", CachedStaticFiles(directory=frontend_path, html=True), name="frontend")
 
 